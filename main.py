@@ -1,15 +1,21 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Optional, Set
+from typing import Deque, Dict, List, Optional, Set
 import httpx
+import msgspec
 import asyncio
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+import random
+import time
+from collections import deque
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+from cachetools import Cache, LRUCache, TLRUCache
 
 # Load environment variables from .env file
 load_dotenv()
@@ -32,55 +38,168 @@ class UserResponse(BaseModel):
     users: List[UserInfo]
     total_count: int
 
+# Freelancer API response structs, modelling only the fields we read
+class FreelancerCountry(msgspec.Struct):
+    name: Optional[str] = None
+
+class FreelancerLocation(msgspec.Struct):
+    country: Optional[FreelancerCountry] = None
+
+class FreelancerUser(msgspec.Struct):
+    username: Optional[str] = None
+    location: Optional[FreelancerLocation] = None
+
+class FreelancerUserResponse(msgspec.Struct):
+    result: Optional[FreelancerUser] = None
+
+freelancer_response_decoder = msgspec.json.Decoder(FreelancerUserResponse)
+
+class UserNotFoundError(Exception):
+    """Raised when the Freelancer API reports that a user does not exist"""
+
 # Global queue and processing state
-user_queue: asyncio.Queue = None
-processing_users: Set[int] = set()
-queue_lock = asyncio.Lock()
+# A plain deque plus an Event is enough for one worker and avoids asyncio.Queue's per-item futures
+user_queue: Deque[int] = deque()
+queue_event: asyncio.Event = None
+# Futures for users waiting on the worker, resolved with their UserInfo once fetched
+pending_users: Dict[int, asyncio.Future] = {}
+# Failed API attempts per user and the delayed re-queue tasks waiting on backoff
+retry_attempts: Dict[int, int] = {}
+retry_tasks: Set[asyncio.Task] = set()
+
+# Shared HTTP client (created in lifespan) so keep-alive connections are reused
+http_client: httpx.AsyncClient = None
+# Bounds in-flight Freelancer API requests (created in lifespan)
+api_semaphore: asyncio.Semaphore = None
 
 # MongoDB connection
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "user_crawler")
 COLLECTION_NAME = "users"
 
+# Short stored field names keep documents and the user_id index small
+FIELD_USER_ID = "u"
+FIELD_USERNAME = "n"
+FIELD_COUNTRY = "c"
+FIELD_CREATED_AT = "t"
+
+# Field names used by earlier versions, renamed in place on startup
+LEGACY_FIELD_NAMES = {
+    "user_id": FIELD_USER_ID,
+    "username": FIELD_USERNAME,
+    "country": FIELD_COUNTRY,
+    "created_at": FIELD_CREATED_AT
+}
+LEGACY_USER_ID_INDEX_NAME = "user_id_1"
+MIGRATION_USER_ID_INDEX_NAME = f"{FIELD_USER_ID}_migration"
+
+# Expire stored users after this many seconds so they get re-crawled (0 keeps them forever)
+USER_TTL_SECONDS = int(os.getenv("USER_TTL_SECONDS", "0"))
+USER_TTL_INDEX_NAME = f"{FIELD_CREATED_AT}_1"
+
+def user_cache_expiry(user_id: int, user_info: UserInfo, now: float) -> float:
+    """Expire a cached user when its stored document reaches the TTL, not a full TTL after caching"""
+    if user_info.created_at is None:
+        return now
+    return user_info.created_at.replace(tzinfo=timezone.utc).timestamp() + USER_TTL_SECONDS
+
+# In-memory cache of users already stored in MongoDB; with a TTL, entries expire on the
+# wall clock at the same created_at + USER_TTL_SECONDS deadline as their documents
+USER_CACHE_SIZE = 50_000
+user_cache: Cache = (
+    TLRUCache(maxsize=USER_CACHE_SIZE, ttu=user_cache_expiry, timer=time.time) if USER_TTL_SECONDS > 0
+    else LRUCache(maxsize=USER_CACHE_SIZE)
+)
+# Last ETag and user info seen per user, kept past expiry so re-crawls can use conditional GETs
+# (only filled when USER_TTL_SECONDS is set, since users are never re-crawled otherwise)
+user_etags: LRUCache = LRUCache(maxsize=USER_CACHE_SIZE)
+
+# Maximum number of queued users fetched and saved together by the worker
+QUEUE_BATCH_SIZE = 50
+
+# Limit users in flight (queued or waiting on a retry) to prevent memory issues
+QUEUE_MAX_SIZE = 1000
+
+# Maximum time a request waits for a queued user to be fetched
+USER_WAIT_TIMEOUT = 10.0
+
+# Capped exponential backoff for re-queuing users after failed API calls
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Give up on a user after this many failed API attempts
+MAX_RETRY_ATTEMPTS = 5
+
+# Maximum number of Freelancer API requests in flight at once; also sizes the HTTP connection
+# pool so requests never wait for a connection even if the server falls back to HTTP/1.1
+MAX_CONCURRENT_API_REQUESTS = 20
+
 # Freelancer API configuration
 FREELANCER_API_BASE = os.getenv("FREELANCER_API_BASE", "https://www.freelancer.com/api/users/0.1/users")
 FREELANCER_OAUTH_TOKEN = os.getenv("FREELANCER_OAUTH_TOKEN", "")
 FREELANCER_CLIENT_ID = os.getenv("FREELANCER_CLIENT_ID", "")
 
-try:
-    client = MongoClient(MONGODB_URL)
-    db = client[DATABASE_NAME]
-    collection = db[COLLECTION_NAME]
-    
-    # Create index on user_id for faster queries
-    collection.create_index("user_id", unique=True)
-    logger.info("Connected to MongoDB successfully")
-except Exception as e:
-    logger.error(f"Failed to connect to MongoDB: {e}")
-    raise
+# Fail fast on unreachable MongoDB instead of hanging startup
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = 5000
+
+# MongoDB client and collection (connected in lifespan)
+client: AsyncIOMotorClient = None
+collection = None
 
 class QueuedUserService:
     
+    @staticmethod
+    def user_info_from_doc(user_doc: dict) -> UserInfo:
+        """Build user info from a stored MongoDB document (already validated on write)"""
+        return UserInfo.model_construct(
+            user_id=user_doc[FIELD_USER_ID],
+            username=user_doc[FIELD_USERNAME],
+            country=user_doc[FIELD_COUNTRY],
+            created_at=user_doc.get(FIELD_CREATED_AT)
+        )
+
     @staticmethod
     async def get_user_from_db(user_id: int) -> Optional[UserInfo]:
-        """Get user info from database"""
+        """Get user info from cache or database"""
+        user_info = user_cache.get(user_id)
+        if user_info:
+            return user_info
+        
         try:
-            user_doc = collection.find_one({"user_id": user_id})
+            user_doc = await collection.find_one({FIELD_USER_ID: user_id})
             if user_doc:
-                return UserInfo(
-                    user_id=user_doc["user_id"],
-                    username=user_doc["username"],
-                    country=user_doc["country"],
-                    created_at=user_doc.get("created_at")
-                )
+                user_info = QueuedUserService.user_info_from_doc(user_doc)
+                user_cache[user_id] = user_info
+                return user_info
             return None
         except Exception as e:
-            logger.error(f"Error getting user {user_id} from DB: {e}")
+            logger.error("Error getting user %d from DB: %s", user_id, e)
             return None
 
+    @staticmethod
+    async def get_users_from_db(user_ids: List[int]) -> Dict[int, UserInfo]:
+        """Get info for several users from cache or database with a single query"""
+        # Use get() rather than `in` + [] since a TTLCache entry can expire between the two
+        users = {}
+        for user_id in user_ids:
+            user_info = user_cache.get(user_id)
+            if user_info is not None:
+                users[user_id] = user_info
+        uncached_user_ids = [user_id for user_id in user_ids if user_id not in users]
+        if not uncached_user_ids:
+            return users
+        
+        try:
+            async for user_doc in collection.find({FIELD_USER_ID: {"$in": uncached_user_ids}}):
+                user_info = QueuedUserService.user_info_from_doc(user_doc)
+                user_cache[user_info.user_id] = user_info
+                users[user_info.user_id] = user_info
+        except Exception as e:
+            logger.error("Error getting %d users from DB: %s", len(uncached_user_ids), e)
+        return users
+
     @staticmethod
     async def get_user_from_freelancer_api(user_id: int) -> Optional[UserInfo]:
-        """Get user info from Freelancer API"""
+        """Get user info from Freelancer API, raising UserNotFoundError for unknown users"""
         try:
             # Check if authentication is configured
             if not FREELANCER_OAUTH_TOKEN and not FREELANCER_CLIENT_ID:
@@ -97,112 +216,160 @@ class QueuedUserService:
                 # Client ID authentication (alternative method)
                 headers["Freelancer-Developer-OAuth-Client-Id"] = FREELANCER_CLIENT_ID
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                url = f"{FREELANCER_API_BASE}/{user_id}"
-                logger.debug(f"Making API request to: {url}")
-                response = await client.get(url, headers=headers)
+            # Ask for the body only if the user changed since the last crawl
+            cached_etag = user_etags.get(user_id)
+            if cached_etag:
+                headers["If-None-Match"] = cached_etag[0]
+            
+            url = f"/{user_id}"
+            logger.debug("Making API request to: %s%s", FREELANCER_API_BASE, url)
+            async with api_semaphore:
+                response = await http_client.get(url, headers=headers)
+            
+            if response.status_code == 304 and cached_etag:
+                logger.debug("User %d not modified on Freelancer", user_id)
+                return cached_etag[1].model_copy()
+            elif response.status_code == 401:
+                logger.error("Authentication failed for Freelancer API. Check your OAuth token or Client ID")
+                return None
+            elif response.status_code == 403:
+                logger.error("Access forbidden for user %d. Check API permissions or rate limits", user_id)
+                return None
+            elif response.status_code == 404:
+                logger.warning("User %d not found on Freelancer", user_id)
+                raise UserNotFoundError(user_id)
+            elif response.status_code == 429:
+                logger.warning("Rate limit exceeded for Freelancer API")
+                return None
+            elif response.status_code == 200:
+                # Decode straight into the structs above, skipping every field we don't use
+                # Freelancer API returns: {"status": "success", "result": {...user_data...}}
+                data = freelancer_response_decoder.decode(response.content)
+                logger.debug("API response for user %d: %s", user_id, data)
                 
-                if response.status_code == 401:
-                    logger.error(f"Authentication failed for Freelancer API. Check your OAuth token or Client ID")
-                    return None
-                elif response.status_code == 403:
-                    logger.error(f"Access forbidden for user {user_id}. Check API permissions or rate limits")
-                    return None
-                elif response.status_code == 404:
-                    logger.warning(f"User {user_id} not found on Freelancer")
-                    return None
-                elif response.status_code == 429:
-                    logger.warning(f"Rate limit exceeded for Freelancer API")
-                    return None
-                elif response.status_code == 200:
-                    data = response.json()
-                    logger.debug(f"API response for user {user_id}: {data}")
+                # Structs are always truthy, so an empty {"result": {}} has to be caught by its fields
+                if data.result and data.result.username:
+                    user_data = data.result
                     
-                    # Extract user info from API response
-                    # Freelancer API returns: {"status": "success", "result": {...user_data...}}
-                    if "result" in data and data["result"]:
-                        user_data = data["result"]
-                        
-                        # Extract username and country
-                        username = user_data.get("username", "")
-                        
-                        # Extract country from location
-                        country = ""
-                        if "location" in user_data and user_data["location"]:
-                            location = user_data["location"]
-                            if "country" in location and location["country"]:
-                                country = location["country"].get("name", "")
-                        
-                        return UserInfo(
-                            user_id=user_id,
-                            username=username,
-                            country=country,
-                            created_at=datetime.utcnow()
-                        )
-                    else:
-                        logger.warning(f"Unexpected API response structure for user {user_id}")
-                        return None
+                    # Extract country from location
+                    country = ""
+                    if user_data.location and user_data.location.country:
+                        country = user_data.location.country.name or ""
+                    
+                    user_info = UserInfo(
+                        user_id=user_id,
+                        username=user_data.username,
+                        country=country
+                    )
+                    etag = response.headers.get("ETag")
+                    if etag and USER_TTL_SECONDS > 0:
+                        user_etags[user_id] = (etag, user_info)
+                    return user_info
                 else:
-                    logger.warning(f"Failed to get user {user_id} from Freelancer API: Status {response.status_code}, Response: {response.text}")
+                    logger.warning("Unexpected API response structure for user %d", user_id)
                     return None
-                
+            else:
+                logger.warning("Failed to get user %d from Freelancer API: Status %d, Response: %s", user_id, response.status_code, response.text)
+                return None
+            
+        except UserNotFoundError:
+            raise
         except httpx.TimeoutException:
-            logger.error(f"Timeout when fetching user {user_id} from Freelancer API")
+            logger.error("Timeout when fetching user %d from Freelancer API", user_id)
             return None
         except Exception as e:
-            logger.error(f"Error fetching user {user_id} from Freelancer API: {e}")
+            logger.error("Error fetching user %d from Freelancer API: %s", user_id, e)
             return None
 
     @staticmethod
-    async def save_user_to_db(user_info: UserInfo) -> bool:
-        """Save user info to database"""
-        try:
-            user_doc = {
-                "user_id": user_info.user_id,
-                "username": user_info.username,
-                "country": user_info.country,
-                "created_at": user_info.created_at or datetime.utcnow()
+    def cache_users(user_infos: List[UserInfo]) -> None:
+        """Warm the in-memory cache with users that are stored in the database"""
+        for user_info in user_infos:
+            user_cache[user_info.user_id] = user_info
+
+    @staticmethod
+    async def save_users_to_db(user_infos: List[UserInfo]) -> bool:
+        """Save a batch of user info to database"""
+        # One timestamp for the whole batch instead of one per fetched user
+        now = datetime.utcnow()
+        user_docs = [
+            {
+                FIELD_USER_ID: user_info.user_id,
+                FIELD_USERNAME: user_info.username,
+                FIELD_COUNTRY: user_info.country,
+                FIELD_CREATED_AT: now
             }
+            for user_info in user_infos
+        ]
+        
+        # Upsert with $setOnInsert so existing users are skipped server-side
+        # instead of surfacing as duplicate key errors
+        operations = [
+            UpdateOne({FIELD_USER_ID: user_doc[FIELD_USER_ID]}, {"$setOnInsert": user_doc}, upsert=True)
+            for user_doc in user_docs
+        ]
+        
+        try:
+            result = await collection.bulk_write(operations, ordered=False)
+            logger.info("Saved %d new users to database (%d already existed)", result.upserted_count, len(user_docs) - result.upserted_count)
+            
+            # Only inserted users carry the new timestamp; skipped ones keep their stored one
+            inserted_users = [user_infos[index] for index in result.upserted_ids]
+            for user_info in inserted_users:
+                user_info.created_at = now
+            QueuedUserService.cache_users(inserted_users)
             
-            collection.insert_one(user_doc)
-            logger.info(f"Saved user {user_info.user_id} to database")
+            existing_users = [
+                user_info for index, user_info in enumerate(user_infos) if index not in result.upserted_ids
+            ]
+            if existing_users:
+                stored_users = await QueuedUserService.get_users_from_db(
+                    [user_info.user_id for user_info in existing_users]
+                )
+                for user_info in existing_users:
+                    stored_user = stored_users.get(user_info.user_id)
+                    if stored_user:
+                        user_info.created_at = stored_user.created_at
             return True
             
-        except DuplicateKeyError:
-            logger.warning(f"User {user_info.user_id} already exists in database")
-            return True  # Still consider as success since data exists
         except Exception as e:
-            logger.error(f"Error saving user {user_info.user_id} to DB: {e}")
+            logger.error("Error saving %d users to DB: %s", len(user_docs), e)
             return False
 
     @staticmethod
-    async def add_to_queue_if_needed(user_id: int) -> bool:
-        """Add user to queue if not already processing"""
-        async with queue_lock:
-            if user_id not in processing_users:
-                processing_users.add(user_id)
-                await user_queue.put(user_id)
-                logger.info(f"Added user {user_id} to processing queue")
-                return True
-            else:
-                logger.info(f"User {user_id} already in processing queue")
-                return False
+    def add_to_queue_if_needed(user_id: int) -> Optional[asyncio.Future]:
+        """Add user to queue if not already processing and return its pending future"""
+        # No lock needed: there is no await between the check and the insert,
+        # so nothing else can run on the event loop in between
+        user_future = pending_users.get(user_id)
+        if user_future is not None:
+            logger.debug("User %d already in processing queue", user_id)
+            return user_future
+        
+        # Count every pending user so ones sleeping on a retry backoff aren't missed
+        if len(pending_users) >= QUEUE_MAX_SIZE:
+            logger.warning("Processing queue is full, cannot queue user %d", user_id)
+            return None
+        
+        enqueue_user(user_id)
+        user_future = asyncio.get_running_loop().create_future()
+        pending_users[user_id] = user_future
+        logger.debug("Added user %d to processing queue", user_id)
+        return user_future
 
     @staticmethod
-    async def wait_for_user_data(user_id: int, max_retries: int = 10, retry_delay: float = 1.0) -> Optional[UserInfo]:
-        """Wait for user data to appear in database (for queued users)"""
-        for attempt in range(max_retries):
-            user_info = await QueuedUserService.get_user_from_db(user_id)
-            if user_info:
-                logger.info(f"User {user_id} data found after {attempt + 1} attempts")
-                return user_info
-            
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-                logger.debug(f"Waiting for user {user_id} data, attempt {attempt + 1}/{max_retries}")
+    async def get_user_from_queue(user_id: int) -> Optional[UserInfo]:
+        """Queue user for fetching (or join the pending fetch) and wait for the worker to resolve it"""
+        user_future = QueuedUserService.add_to_queue_if_needed(user_id)
+        if user_future is None:
+            return None
         
-        logger.warning(f"User {user_id} data not found after {max_retries} attempts")
-        return None
+        try:
+            # Shield so a timed-out waiter doesn't cancel the future shared with other waiters
+            return await asyncio.wait_for(asyncio.shield(user_future), timeout=USER_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("User %d data not available after %s seconds", user_id, USER_WAIT_TIMEOUT)
+            return None
 
     @staticmethod
     async def get_user_info(user_id: int) -> Optional[UserInfo]:
@@ -210,95 +377,214 @@ class QueuedUserService:
         # First check database
         user_info = await QueuedUserService.get_user_from_db(user_id)
         if user_info:
-            logger.info(f"Found user {user_id} in database")
+            logger.debug("Found user %d in database", user_id)
             return user_info
         
-        # Check if user is already being processed
-        async with queue_lock:
-            is_processing = user_id in processing_users
-        
-        if is_processing:
-            # Wait for the processing to complete
-            logger.info(f"User {user_id} is being processed, waiting...")
-            return await QueuedUserService.wait_for_user_data(user_id)
-        else:
-            # Add to queue and wait
-            await QueuedUserService.add_to_queue_if_needed(user_id)
-            logger.info(f"User {user_id} added to queue, waiting for processing...")
-            return await QueuedUserService.wait_for_user_data(user_id)
+        return await QueuedUserService.get_user_from_queue(user_id)
+
+def enqueue_user(user_id: int) -> None:
+    """Append a user to the queue and wake up the worker"""
+    user_queue.append(user_id)
+    queue_event.set()
+
+def resolve_user(user_id: int, user_info: Optional[UserInfo]) -> None:
+    """Finish processing a user and wake up everyone waiting on it"""
+    retry_attempts.pop(user_id, None)
+    user_future = pending_users.pop(user_id, None)
+    if user_future and not user_future.done():
+        user_future.set_result(user_info)
+
+def schedule_retry(user_id: int) -> None:
+    """Re-queue a user after a capped exponential backoff with jitter"""
+    attempts = retry_attempts.get(user_id, 0)
+    if attempts >= MAX_RETRY_ATTEMPTS:
+        logger.error("Giving up on user %d after %d failed attempts", user_id, attempts + 1)
+        resolve_user(user_id, None)
+        return
+    
+    retry_attempts[user_id] = attempts + 1
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts) * random.uniform(0.5, 1.5)
+    logger.info("Retrying user %d in %.1f seconds (attempt %d)", user_id, delay, attempts + 1)
+    
+    # Sleep in a separate task so the worker keeps processing other users meanwhile
+    retry_task = asyncio.create_task(requeue_user_after(user_id, delay))
+    retry_tasks.add(retry_task)
+    retry_task.add_done_callback(retry_tasks.discard)
+
+async def requeue_user_after(user_id: int, delay: float):
+    """Put a user back on the queue once its backoff delay has passed"""
+    await asyncio.sleep(delay)
+    enqueue_user(user_id)
 
 async def queue_worker():
-    """Background worker to process user queue"""
+    """Background worker to process user queue in batches"""
     logger.info("Queue worker started")
     
     while True:
         try:
-            # Get user ID from queue (wait indefinitely)
-            user_id = await user_queue.get()
-            logger.info(f"Processing user {user_id} from queue")
+            # Wait for at least one user, then drain whatever else is already queued
+            while not user_queue:
+                queue_event.clear()
+                await queue_event.wait()
+            batch = [user_queue.popleft() for _ in range(min(len(user_queue), QUEUE_BATCH_SIZE))]
+            logger.debug("Processing batch of %d users from queue", len(batch))
             
             try:
-                # Attempt to get user info from API
-                user_info = await QueuedUserService.get_user_from_freelancer_api(user_id)
+                # Fetch all users in the batch concurrently
+                results = await asyncio.gather(
+                    *[QueuedUserService.get_user_from_freelancer_api(user_id) for user_id in batch],
+                    return_exceptions=True
+                )
+                
+                fetched_users = []
+                failed_user_ids = []
+                for user_id, result in zip(batch, results):
+                    if isinstance(result, UserNotFoundError):
+                        # Permanent failure, no point in retrying
+                        resolve_user(user_id, None)
+                    elif isinstance(result, Exception):
+                        logger.error("Error processing user %d: %s", user_id, result)
+                        failed_user_ids.append(user_id)
+                    elif result is None:
+                        failed_user_ids.append(user_id)
+                    else:
+                        fetched_users.append(result)
                 
-                if user_info:
+                if fetched_users:
                     # Try to save to database with retries
                     max_save_retries = 3
                     save_success = False
                     
                     for save_attempt in range(max_save_retries):
-                        save_success = await QueuedUserService.save_user_to_db(user_info)
+                        save_success = await QueuedUserService.save_users_to_db(fetched_users)
                         if save_success:
-                            logger.info(f"Successfully processed user {user_id}")
+                            logger.info("Successfully processed %d users", len(fetched_users))
                             break
                         else:
-                            logger.warning(f"Failed to save user {user_id} to database, attempt {save_attempt + 1}/{max_save_retries}")
+                            logger.warning("Failed to save %d users to database, attempt %d/%d", len(fetched_users), save_attempt + 1, max_save_retries)
                             if save_attempt < max_save_retries - 1:
                                 await asyncio.sleep(1)  # Wait 1 second before retry
                     
                     if not save_success:
-                        logger.error(f"Failed to save user {user_id} to database after {max_save_retries} attempts")
+                        logger.error("Failed to save %d users to database after %d attempts", len(fetched_users), max_save_retries)
                         # Don't re-queue since we have the data from API - this is a persistent DB issue
-                else:
-                    logger.warning(f"Failed to get user {user_id} from API, re-queuing")
-                    # Re-queue for retry (with delay to avoid immediate retry)
-                    await asyncio.sleep(5)  # Wait 5 seconds before retry
-                    await user_queue.put(user_id)
-                    continue
+                    
+                    # Resolve waiters once we have user_info (successful API call)
+                    # regardless of database save result, since DB issues shouldn't cause re-queuing
+                    for user_info in fetched_users:
+                        resolve_user(user_info.user_id, user_info)
+                
+                if failed_user_ids:
+                    logger.warning("Failed to get %d users from API, re-queuing", len(failed_user_ids))
+                    # Re-queue for retry with backoff to avoid hammering the API
+                    for user_id in failed_user_ids:
+                        schedule_retry(user_id)
                     
             except Exception as e:
-                logger.error(f"Error processing user {user_id}: {e}")
+                logger.error("Error processing batch %s: %s", batch, e)
                 # Re-queue for retry
-                await asyncio.sleep(5)
-                await user_queue.put(user_id)
-                continue
-            
-            finally:
-                # Remove from processing set when we have user_info (successful API call)
-                # regardless of database save result, since DB issues shouldn't cause re-queuing
-                if user_info:
-                    async with queue_lock:
-                        processing_users.discard(user_id)
-                
-                # Mark task as done only if we got user_info (successful API call)
-                # If API call failed, we re-queued, so don't mark as done
-                if user_info:
-                    user_queue.task_done()
+                for user_id in batch:
+                    if user_id in pending_users:
+                        schedule_retry(user_id)
                 
         except asyncio.CancelledError:
             logger.info("Queue worker cancelled")
             break
         except Exception as e:
-            logger.error(f"Unexpected error in queue worker: {e}")
+            logger.error("Unexpected error in queue worker: %s", e)
             await asyncio.sleep(1)
 
+async def migrate_legacy_documents():
+    """Rename long field names from earlier versions so existing users are kept"""
+    # Only collections created by earlier versions (or a half-finished migration) carry these
+    # indexes, so normal startups skip the migration without touching any documents
+    index_names = await collection.index_information()
+    if LEGACY_USER_ID_INDEX_NAME not in index_names and MIGRATION_USER_ID_INDEX_NAME not in index_names:
+        return
+    
+    logger.info("Migrating users to short field names")
+    
+    # Partial unique index on the new field while legacy documents don't have it yet;
+    # it is dropped last so an interrupted migration resumes on the next startup
+    await collection.create_index(
+        FIELD_USER_ID, name=MIGRATION_USER_ID_INDEX_NAME, unique=True,
+        partialFilterExpression={FIELD_USER_ID: {"$exists": True}}
+    )
+    
+    # Copy the legacy fields first, keeping user_id so the old unique index stays satisfied
+    result = await collection.update_many(
+        {"user_id": {"$exists": True}, FIELD_USER_ID: {"$exists": False}},
+        [
+            {"$set": {new: f"${old}" for old, new in LEGACY_FIELD_NAMES.items()}},
+            {"$unset": [old for old in LEGACY_FIELD_NAMES if old != "user_id"]}
+        ]
+    )
+    logger.info("Migrated %d users to short field names", result.modified_count)
+    
+    if LEGACY_USER_ID_INDEX_NAME in index_names:
+        await collection.drop_index(LEGACY_USER_ID_INDEX_NAME)
+    await collection.update_many({"user_id": {"$exists": True}}, {"$unset": {"user_id": ""}})
+    await collection.drop_index(MIGRATION_USER_ID_INDEX_NAME)
+
+async def sync_ttl_index():
+    """Create, update or drop the TTL index so it matches USER_TTL_SECONDS"""
+    ttl_index = (await collection.index_information()).get(USER_TTL_INDEX_NAME)
+    
+    if USER_TTL_SECONDS > 0:
+        if ttl_index is None:
+            await collection.create_index(FIELD_CREATED_AT, name=USER_TTL_INDEX_NAME, expireAfterSeconds=USER_TTL_SECONDS)
+        elif ttl_index.get("expireAfterSeconds") != USER_TTL_SECONDS:
+            # create_index would fail with IndexOptionsConflict, collMod changes the TTL in place
+            await collection.database.command(
+                "collMod", COLLECTION_NAME,
+                index={"name": USER_TTL_INDEX_NAME, "expireAfterSeconds": USER_TTL_SECONDS}
+            )
+            logger.info("Updated user TTL to %d seconds", USER_TTL_SECONDS)
+    elif ttl_index is not None:
+        await collection.drop_index(USER_TTL_INDEX_NAME)
+        logger.info("Dropped user TTL index")
+
+async def connect_to_mongodb():
+    """Connect to MongoDB and make sure the indexes exist"""
+    global client, collection
+    
+    try:
+        client = AsyncIOMotorClient(MONGODB_URL, serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS)
+        db = client[DATABASE_NAME]
+        collection = db[COLLECTION_NAME]
+        
+        # Create index on user_id for faster queries, plus an optional TTL index for re-crawling
+        await migrate_legacy_documents()
+        await collection.create_index(FIELD_USER_ID, unique=True)
+        await sync_ttl_index()
+        logger.info("Connected to MongoDB successfully")
+    except Exception as e:
+        logger.error("Failed to connect to MongoDB: %s", e)
+        raise
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifespan"""
-    global user_queue
+    global queue_event, http_client, api_semaphore
     
     # Startup
-    user_queue = asyncio.Queue(maxsize=1000)  # Limit queue size to prevent memory issues
+    await connect_to_mongodb()
+    
+    queue_event = asyncio.Event()
+    api_semaphore = asyncio.Semaphore(MAX_CONCURRENT_API_REQUESTS)
+    
+    # Single long-lived HTTP/2 client so concurrent requests to the Freelancer API
+    # multiplex over a few persistent connections instead of opening new ones
+    http_client = httpx.AsyncClient(
+        base_url=FREELANCER_API_BASE,
+        timeout=30.0,
+        limits=httpx.Limits(
+            max_keepalive_connections=MAX_CONCURRENT_API_REQUESTS,
+            max_connections=MAX_CONCURRENT_API_REQUESTS,
+            keepalive_expiry=300
+        ),
+        http2=True
+    )
     
     # Start queue worker
     worker_task = asyncio.create_task(queue_worker())
@@ -312,16 +598,26 @@ async def lifespan(app: FastAPI):
         await worker_task
     except asyncio.CancelledError:
         pass
+    for retry_task in list(retry_tasks):
+        retry_task.cancel()
+    await http_client.aclose()
+    client.close()
     logger.info("Application shutdown complete")
 
 # FastAPI app with lifespan management
-app = FastAPI(title="User Info API with Queue", version="1.1.0", lifespan=lifespan)
+# orjson encodes responses (including datetimes) much faster than the stdlib json encoder
+app = FastAPI(
+    title="User Info API with Queue",
+    version="1.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 @app.get("/")
 async def root():
     """Health check endpoint"""
-    queue_size = user_queue.qsize() if user_queue else 0
-    processing_count = len(processing_users)
+    queue_size = len(user_queue)
+    processing_count = len(pending_users)
     
     return {
         "message": "User Info API with Queue is running", 
@@ -347,25 +643,35 @@ async def get_users_info(request: UserRequest):
     if len(request.user_ids) > 100:  # Reasonable limit to prevent abuse
         raise HTTPException(status_code=400, detail="Maximum 100 user IDs allowed per request")
     
-    logger.info(f"Processing request for {len(request.user_ids)} users")
+    logger.info("Processing request for %d users", len(request.user_ids))
+    
+    # Look up all already stored users with a single query
+    found_users = await QueuedUserService.get_users_from_db(request.user_ids)
+    missing_user_ids = list(dict.fromkeys(
+        user_id for user_id in request.user_ids if user_id not in found_users
+    ))
+    logger.debug("Found %d users in database, queuing %d", len(found_users), len(missing_user_ids))
     
-    # Create tasks for concurrent processing
-    tasks = [QueuedUserService.get_user_info(user_id) for user_id in request.user_ids]
+    # Create tasks for concurrent processing of the missing users only
+    tasks = [QueuedUserService.get_user_from_queue(user_id) for user_id in missing_user_ids]
     
     # Execute all tasks concurrently
     results = await asyncio.gather(*tasks, return_exceptions=True)
     
     # Process results
-    users = []
-    for i, result in enumerate(results):
+    for user_id, result in zip(missing_user_ids, results):
         if isinstance(result, Exception):
-            logger.error(f"Error processing user {request.user_ids[i]}: {result}")
+            logger.error("Error processing user %d: %s", user_id, result)
         elif result is not None:
-            users.append(result)
+            found_users[user_id] = result
         else:
-            logger.warning(f"No data found for user {request.user_ids[i]}")
+            logger.warning("No data found for user %d", user_id)
+    
+    # Preserve the requested order
+    users = [found_users[user_id] for user_id in request.user_ids if user_id in found_users]
     
-    return UserResponse(
+    # Users are already validated UserInfo instances, skip re-validation
+    return UserResponse.model_construct(
         users=users,
         total_count=len(users)
     )
@@ -392,33 +698,34 @@ async def get_single_user_info(user_id: int):
 async def get_stats():
     """Get database and queue statistics"""
     try:
-        total_users = collection.count_documents({})
-        queue_size = user_queue.qsize() if user_queue else 0
-        processing_count = len(processing_users)
+        total_users = await collection.count_documents({})
+        queue_size = len(user_queue)
+        processing_count = len(pending_users)
         
         return {
             "total_users_cached": total_users,
+            "memory_cache_size": len(user_cache),
             "database": DATABASE_NAME,
             "collection": COLLECTION_NAME,
             "queue_size": queue_size,
             "processing_count": processing_count,
-            "currently_processing": list(processing_users)
+            "currently_processing": list(pending_users)
         }
     except Exception as e:
-        logger.error(f"Error getting stats: {e}")
+        logger.error("Error getting stats: %s", e)
         raise HTTPException(status_code=500, detail="Error getting statistics")
 
 @app.get("/api/queue")
 async def get_queue_info():
     """Get detailed queue information"""
-    queue_size = user_queue.qsize() if user_queue else 0
-    processing_count = len(processing_users)
+    queue_size = len(user_queue)
+    processing_count = len(pending_users)
     
     return {
         "queue_size": queue_size,
         "processing_count": processing_count,
-        "currently_processing": list(processing_users),
-        "queue_available": user_queue is not None
+        "currently_processing": list(pending_users),
+        "queue_available": queue_event is not None
     }
 
 if __name__ == "__main__":